@@ -0,0 +1,144 @@
+# app/comfy.py
+import os
+import time
+import random
+import asyncio
+import mimetypes
+from typing import Optional, Dict, Any, List, Tuple
+
+import httpx
+import orjson
+from fastapi import HTTPException
+from fastapi.responses import StreamingResponse
+from starlette.background import BackgroundTask
+
+from .gce import send, raise_http
+
+# ==========================================================
+# Config
+# ==========================================================
+# 例: "http://10.128.0.3:8188"（VM の内部IP:8188）
+COMFY_BASEURL = os.environ.get("COMFY_BASEURL")
+
+# comfy_result のポーリング間隔（指数バックオフ＋ジッタ）
+_POLL_BASE_DELAY = 0.25
+_POLL_GROWTH = 1.3
+# comfy_fetch の転送チャンク（64 KiB）。上流の符号化はそのまま中継する
+_FETCH_CHUNK = 65536
+# 画像/動画は圧縮済みなので上流に gzip させず、ファイルのバイト列をそのまま受け取る
+_FETCH_REQ_HEADERS = {"Accept-Encoding": "identity"}
+_FETCH_PASS_HEADERS = ("content-length", "content-encoding")
+# comfy_ping: 成功結果は短時間キャッシュ、失敗後はしばらく上流に繋がず即 502
+_PING_CACHE_SEC = 2.0
+_PING_FAIL_SEC = 5.0
+# ComfyUI が出力する拡張子のみ。それ以外は mimetypes にフォールバック
+_MIME = {
+    "png": "image/png",
+    "jpg": "image/jpeg",
+    "jpeg": "image/jpeg",
+    "webp": "image/webp",
+    "gif": "image/gif",
+    "mp4": "video/mp4",
+}
+
+# ==========================================================
+# Helpers
+# ==========================================================
+async def comfy_get(path: str, params: Optional[Dict[str, Any]] = None, stream: bool = False,
+                    headers: Optional[Dict[str, str]] = None) -> httpx.Response:
+    if not COMFY_BASEURL:
+        raise HTTPException(500, "COMFY_BASEURL not set")
+    url = f"{COMFY_BASEURL.rstrip('/')}/{path.lstrip('/')}"
+    r = await send("GET", url, params=params, headers=headers, stream=stream)
+    if r.status_code >= 300:
+        if stream:
+            await r.aread()
+            await r.aclose()
+        raise_http(r.status_code, r.text)
+    return r
+
+async def comfy_post(path: str, json: Dict[str, Any]) -> httpx.Response:
+    if not COMFY_BASEURL:
+        raise HTTPException(500, "COMFY_BASEURL not set")
+    url = f"{COMFY_BASEURL.rstrip('/')}/{path.lstrip('/')}"
+    r = await send("POST", url, content=orjson.dumps(json),
+                   headers={"Content-Type": "application/json"})
+    if r.status_code >= 300:
+        raise_http(r.status_code, r.text)
+    return r
+
+_ping_cache: Optional[Tuple[float, Dict[str, Any]]] = None  # (取得時刻, 結果)
+_ping_fail_until = 0.0
+_ping_last_error = ""
+
+async def ping() -> Dict[str, Any]:
+    global _ping_cache, _ping_fail_until, _ping_last_error
+    now = time.monotonic()
+    if _ping_cache and now - _ping_cache[0] < _PING_CACHE_SEC:
+        return _ping_cache[1]
+    if now < _ping_fail_until:
+        raise HTTPException(502, f"connect failed: {_ping_last_error}")
+    try:
+        r = await comfy_get("/system_stats")
+    except Exception as e:
+        _ping_cache = None
+        _ping_fail_until = time.monotonic() + _PING_FAIL_SEC
+        _ping_last_error = str(e)
+        raise HTTPException(502, f"connect failed: {e}")
+    res = {"ok": r.is_success, "status": r.status_code}
+    _ping_cache = (time.monotonic(), res)
+    return res
+
+def warm_mimetypes() -> None:
+    # /etc/mime.types の読み込みを起動時に済ませ、初回リクエストで払わない
+    mimetypes.init()
+
+def poll_delay(attempt: int, max_delay: float) -> float:
+    # 速く終わるジョブにはすぐ気付き、遅いジョブでは max_delay 付近で頭打ち
+    return min(max_delay, _POLL_BASE_DELAY * (_POLL_GROWTH ** attempt)) * (1 + random.uniform(0, 0.5))
+
+async def wait_result(prompt_id: str, timeout_sec: float, poll_interval: float) -> Dict[str, Any]:
+    """
+    /history/<prompt_id> をポーリングし、生成画像のファイル名一覧を返す。
+    返り値: {"done": true/false, "files": [...], "error": "...(任意)"}
+    """
+    deadline = time.time() + timeout_sec
+    last_error: Optional[str] = None
+    attempt = 0
+
+    while time.time() < deadline:
+        try:
+            r = await comfy_get(f"/history/{prompt_id}")
+            # 404 でなければ JSON
+            hist = orjson.loads(r.content)
+            # outputs が出るまではノードを走査しない
+            outputs = (hist.get(prompt_id) or {}).get("outputs")
+            if outputs:
+                files: List[str] = [img["filename"]
+                                    for out in outputs.values()
+                                    for img in out.get("images", ())
+                                    if img.get("filename")]
+                if files:
+                    return {"done": True, "files": files}
+            # 画像まだ→継続
+        except HTTPException as he:
+            # /history が未作成などで 404 の可能性（raise_http が投げる）
+            last_error = str(he.detail)
+        except Exception as e:
+            last_error = str(e)
+
+        await asyncio.sleep(min(poll_delay(attempt, poll_interval), max(0.0, deadline - time.time())))
+        attempt += 1
+
+    # タイムアウト
+    return {"done": False, "files": [], "error": last_error}
+
+async def fetch_response(filename: str) -> StreamingResponse:
+    r = await comfy_get("/view", params={"filename": filename}, stream=True, headers=_FETCH_REQ_HEADERS)
+    mime = (_MIME.get(filename.rsplit(".", 1)[-1].lower())
+            or mimetypes.guess_type(filename)[0]
+            or "application/octet-stream")
+    headers = {k: r.headers[k] for k in _FETCH_PASS_HEADERS if k in r.headers}
+    # aiter_raw をそのまま渡し、チャンクは上流の bytes を1回も複製せずに送る
+    return StreamingResponse(r.aiter_raw(_FETCH_CHUNK), media_type=mime, headers=headers,
+                             background=BackgroundTask(r.aclose))
@@ -0,0 +1,254 @@
+# app/gce.py
+import os
+import time
+import asyncio
+import functools
+from datetime import datetime, timedelta
+from typing import Optional, Dict, Any, Tuple
+
+import httpx
+import orjson
+from fastapi import HTTPException
+from fastapi.concurrency import run_in_threadpool
+import google.auth.exceptions
+import google.auth.transport
+from google.auth import default as google_auth_default
+
+# ==========================================================
+# Config
+# ==========================================================
+PROJECT_ID = os.environ.get("PROJECT_ID", "")
+ZONE       = os.environ.get("ZONE", "")
+INSTANCE   = os.environ.get("INSTANCE", "")
+API_KEY    = os.environ.get("API_KEY")
+
+# ==========================================================
+# HTTP client（共有 AsyncClient＋軽リトライ＋タイムアウト）
+# ==========================================================
+_DEFAULT_TIMEOUT = httpx.Timeout(30.0, connect=3.0)
+# HTTP/2 で compute.googleapis.com への同時リクエストを1本の接続に多重化する
+_DEFAULT_LIMITS = httpx.Limits(max_keepalive_connections=5, max_connections=200)
+_RETRY_TOTAL = 3
+_RETRY_BACKOFF = 0.5  # 0.5, 1.0, 2.0 秒
+# start/stop の POST は再送すると Operation が二重に作られ得るので、冪等な GET だけ再送
+_RETRY_METHODS = frozenset(["GET"])
+_RETRY_STATUSES = frozenset([500, 502, 503, 504])
+_RETRY_AFTER_MAX = 30.0
+# zoneOperations.wait はサーバ側で最大約2分ブロックするため read を長めに取る
+_OP_WAIT_TIMEOUT = httpx.Timeout(150.0, connect=3.0)
+_OP_WAIT_MAX_SEC = 600.0  # /vm/wait の timeout_sec 上限と同じ
+
+_client: Optional[httpx.AsyncClient] = None
+# google-auth の refresh 用（スレッドプールから呼ばれるので同期クライアント、接続エラーのみ再試行）
+_auth_http = httpx.Client(timeout=_DEFAULT_TIMEOUT, transport=httpx.HTTPTransport(retries=3))
+
+async def open_client() -> None:
+    global _client
+    _client = httpx.AsyncClient(http2=True, timeout=_DEFAULT_TIMEOUT, limits=_DEFAULT_LIMITS)
+
+async def close_client() -> None:
+    if _client is not None:
+        await _client.aclose()
+    _auth_http.close()
+
+# ==========================================================
+# Helpers
+# ==========================================================
+def check_key(x_api_key: Optional[str]) -> None:
+    if API_KEY and x_api_key != API_KEY:
+        raise HTTPException(status_code=401, detail="unauthorized")
+
+def ensure_params(project: str, zone: str, instance: str) -> None:
+    if not (project and zone and instance):
+        raise HTTPException(status_code=400, detail="PROJECT_ID/ZONE/INSTANCE not set")
+
+class _AuthResponse(google.auth.transport.Response):
+    def __init__(self, r: httpx.Response):
+        self._r = r
+
+    @property
+    def status(self) -> int:
+        return self._r.status_code
+
+    @property
+    def headers(self) -> httpx.Headers:
+        return self._r.headers
+
+    @property
+    def data(self) -> bytes:
+        return self._r.content
+
+class _AuthRequest(google.auth.transport.Request):
+    # google-auth の transport を httpx で実装（requests/urllib3 を入れない）
+    def __call__(self, url, method="GET", body=None, headers=None, timeout=None, **kwargs):
+        try:
+            r = _auth_http.request(method, url, content=body, headers=headers,
+                                   timeout=_DEFAULT_TIMEOUT if timeout is None else timeout)
+        except httpx.HTTPError as e:
+            raise google.auth.exceptions.TransportError(e) from e
+        return _AuthResponse(r)
+
+# Credentials はプロセスで1つだけ保持し、期限が近づいた時だけ refresh
+_DEFAULT_SCOPES = ("https://www.googleapis.com/auth/cloud-platform",)
+_TOKEN_REFRESH_SKEW = timedelta(seconds=60)
+_creds = None
+_creds_lock = asyncio.Lock()
+
+def _token_fresh() -> bool:
+    if _creds is None or not _creds.valid:
+        return False
+    return _creds.expiry is None or _creds.expiry - datetime.utcnow() >= _TOKEN_REFRESH_SKEW
+
+async def get_access_token() -> str:
+    global _creds
+    if _token_fresh():
+        return _creds.token
+    async with _creds_lock:
+        # google-auth はブロッキングなのでスレッドプールで実行
+        if _creds is None:
+            _creds, _ = await run_in_threadpool(google_auth_default, scopes=list(_DEFAULT_SCOPES),
+                                                request=_AuthRequest())
+        if not _token_fresh():
+            await run_in_threadpool(_creds.refresh, _AuthRequest())
+    return _creds.token
+
+def raise_http(status: int, text: str):
+    # JSONならそのまま、非JSONは先頭1000文字に圧縮
+    detail: Any = text
+    try:
+        detail = orjson.loads(text)
+    except Exception:
+        detail = {"error": text[:1000]}
+    raise HTTPException(status_code=status, detail=detail)
+
+def _retry_after(r: httpx.Response) -> float:
+    # 秒数指定のみ解釈（HTTP-date などは既定のバックオフ）
+    try:
+        return min(max(float(r.headers.get("Retry-After", "")), 0.0), _RETRY_AFTER_MAX)
+    except ValueError:
+        return _RETRY_BACKOFF
+
+async def send(method: str, url: str, stream: bool = False, **kwargs: Any) -> httpx.Response:
+    # GET は接続エラーと _RETRY_STATUSES を指数バックオフで再送
+    req = _client.build_request(method, url, **kwargs)
+    retries = _RETRY_TOTAL if method in _RETRY_METHODS else 0
+    throttled = False
+    attempt = 0
+    while True:
+        try:
+            r = await _client.send(req, stream=stream)
+        except httpx.TransportError:
+            if attempt >= retries:
+                raise
+        else:
+            if r.status_code == 429 and not throttled:
+                # 429 は処理されずに拒否されているので、メソッドを問わず Retry-After 後に1回だけ再送
+                throttled = True
+                await r.aclose()
+                await asyncio.sleep(_retry_after(r))
+                continue
+            if r.status_code not in _RETRY_STATUSES or attempt >= retries:
+                return r
+            await r.aclose()
+        await asyncio.sleep(_RETRY_BACKOFF * (2 ** attempt))
+        attempt += 1
+
+@functools.lru_cache(maxsize=4)
+def _auth_header(token: str) -> Dict[str, bytes]:
+    # トークンが変わるまで同じ dict を使い回す（呼び出し側で変更しないこと）
+    return {"Authorization": b"Bearer " + token.encode("ascii")}
+
+async def gce_req(method: str, url: str, timeout: Any = httpx.USE_CLIENT_DEFAULT) -> Dict[str, Any]:
+    token = await get_access_token()
+    r = await send(method, url, headers=_auth_header(token), timeout=timeout)
+    if r.status_code >= 300:
+        raise_http(r.status_code, r.text)
+    return orjson.loads(r.content) if r.content else {}
+
+@functools.lru_cache(maxsize=256)
+def instance_url(project: str, zone: str, instance: str, action: str = "") -> str:
+    # action: "" / "/start" / "/stop"。同じ VM への呼び出しは毎回同じ文字列を返す
+    return f"https://compute.googleapis.com/compute/v1/projects/{project}/zones/{zone}/instances/{instance}{action}"
+
+# 既定 VM（単一 VM 運用）の URL は import 時にキャッシュへ載せておく
+if PROJECT_ID and ZONE and INSTANCE:
+    for _action in ("", "/start", "/stop"):
+        instance_url(PROJECT_ID, ZONE, INSTANCE, _action)
+
+# vm_status 用: key -> (ETag, 返却済みの status)
+_status_cache: Dict[Tuple[str, str, str], Tuple[str, Dict[str, Any]]] = {}
+
+async def instance_status(project: str, zone: str, instance: str) -> Dict[str, Any]:
+    """
+    Instance の status を返す。前回の ETag で条件付き GET し、304 なら前回の結果を返す。
+    返り値: {"name": "...", "zone": "...", "status": "..."}
+    """
+    key = (project, zone, instance)
+    cached = _status_cache.get(key)
+    headers = _auth_header(await get_access_token())
+    if cached:
+        headers = {**headers, "If-None-Match": cached[0]}
+    r = await send("GET", instance_url(project, zone, instance), headers=headers)
+    if r.status_code == 304 and cached:
+        return cached[1]
+    if r.status_code >= 300:
+        raise_http(r.status_code, r.text)
+    j = orjson.loads(r.content) if r.content else {}
+    res = {"name": instance, "zone": zone, "status": j.get("status", "UNKNOWN")}
+    etag = r.headers.get("ETag")
+    if etag:
+        _status_cache[key] = (etag, res)
+    return res
+
+def operation_url(project: str, zone: str, operation: str) -> str:
+    return f"https://compute.googleapis.com/compute/v1/projects/{project}/zones/{zone}/operations/{operation}"
+
+# 同じ Operation を待つ呼び出しは1本のポーリングタスクを共有する
+# key -> (タスク, 最新の Operation)
+_op_waits: Dict[Tuple[str, str, str], Tuple["asyncio.Task[None]", Dict[str, Any]]] = {}
+
+async def _poll_operation(project: str, zone: str, operation: str, latest: Dict[str, Any]) -> None:
+    url = operation_url(project, zone, operation) + "/wait"
+    deadline = time.time() + _OP_WAIT_MAX_SEC
+
+    # wait は完了時に即返る。未完了のまま約2分経つと返るので、DONE か上限まで繰り返す
+    while latest.get("status") != "DONE":
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            break
+        try:
+            j = await asyncio.wait_for(gce_req("POST", url, timeout=_OP_WAIT_TIMEOUT), remaining)
+        except asyncio.TimeoutError:
+            break
+        latest.clear()
+        latest.update(j)
+
+def _forget_op_wait(key: Tuple[str, str, str], task: "asyncio.Task[None]") -> None:
+    _op_waits.pop(key, None)
+    if not task.cancelled():
+        task.exception()  # 待ち手がいなくなった後の例外を「未回収」にしない
+
+async def wait_operation(project: str, zone: str, operation: str, timeout_sec: float) -> Dict[str, Any]:
+    """
+    zoneOperations.wait で Operation の完了を待つ（GCE 側のロングポール）。
+    返り値: {"done": true/false, "operation": "...", "status": "...", "error": {...}(任意)}
+    """
+    key = (project, zone, operation)
+    if key not in _op_waits:
+        latest: Dict[str, Any] = {}
+        task = asyncio.create_task(_poll_operation(project, zone, operation, latest))
+        _op_waits[key] = (task, latest)
+        task.add_done_callback(lambda t: _forget_op_wait(key, t))
+    task, j = _op_waits[key]
+
+    try:
+        # shield: 1人がタイムアウトしても共有タスクは止めない
+        await asyncio.wait_for(asyncio.shield(task), timeout_sec)
+    except asyncio.TimeoutError:
+        pass
+
+    res: Dict[str, Any] = {"done": j.get("status") == "DONE", "operation": operation,
+                           "status": j.get("status", "UNKNOWN")}
+    if j.get("error"):
+        res["error"] = j["error"]
+    return res
@@ -1,127 +1,77 @@
 # app/main.py
 import os
-import time
-import mimetypes
-from typing import Optional, Dict, Any, List
+import asyncio
+from typing import Optional, Dict, Any
 
-import requests
-from fastapi import FastAPI, HTTPException, Query, Header
+import orjson
+from anyio import to_thread
+from fastapi import FastAPI, HTTPException, Query, Header, Depends
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse, JSONResponse
-from google.auth import default as google_auth_default
-from google.auth.transport.requests import Request
+from fastapi.responses import ORJSONResponse
+
+from . import gce, comfy
+from .gce import PROJECT_ID, ZONE, INSTANCE, check_key, ensure_params, gce_req, instance_url
+from .comfy import comfy_post, wait_result, fetch_response
 
 # ==========================================================
 # App meta
 # ==========================================================
-app = FastAPI(title="GCE VM Controller", version="1.2.0")
+app = FastAPI(title="GCE VM Controller", version="1.2.0", default_response_class=ORJSONResponse)
 
 # ==========================================================
 # CORS
 # ==========================================================
 _allow_origins = os.environ.get("ALLOW_ORIGINS", "*")
-allow_origins = [o.strip() for o in _allow_origins.split(",")] if _allow_origins else ["*"]
+allow_origins = frozenset(o.strip() for o in _allow_origins.split(",") if o.strip()) or frozenset(["*"])
+# "*" と credentials は仕様上併用できない。ワイルドカード時は credentials なし（Origin の反映も不要になる）
+allow_credentials = "*" not in allow_origins
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=allow_origins,
+    allow_origins=allow_origins,  # frozenset: リクエスト毎の Origin 照合を O(1) に
     allow_methods=["*"],
     allow_headers=["*"],
-    allow_credentials=True,
+    allow_credentials=allow_credentials,
 )
 
 # ==========================================================
-# Config
+# Concurrency（同時処理数の上限。超過分はメモリに溜めず 503 で返す）
 # ==========================================================
-PROJECT_ID = os.environ.get("PROJECT_ID", "")
-ZONE       = os.environ.get("ZONE", "")
-INSTANCE   = os.environ.get("INSTANCE", "")
-API_KEY    = os.environ.get("API_KEY")
-# 例: "http://10.128.0.3:8188"（VM の内部IP:8188）
-COMFY_BASEURL = os.environ.get("COMFY_BASEURL")
+MAX_CONCURRENCY = int(os.environ.get("MAX_CONCURRENCY", "16"))
+_slots = asyncio.Semaphore(MAX_CONCURRENCY)
 
-# ==========================================================
-# Requests session（軽リトライ＋タイムアウト）
-# ==========================================================
-_session = requests.Session()
-from requests.adapters import HTTPAdapter, Retry  # type: ignore
-_retry = Retry(
-    total=3,
-    backoff_factor=0.5,
-    status_forcelist=[429, 500, 502, 503, 504],
-    allowed_methods=frozenset(["GET", "POST"])
-)
-_session.mount("https://", HTTPAdapter(max_retries=_retry))
-_session.mount("http://",  HTTPAdapter(max_retries=_retry))
-_DEFAULT_TIMEOUT = (3, 30)  # (connect, read) seconds
+async def concurrency_slot():
+    if _slots.locked():
+        raise HTTPException(status_code=503, detail={"code": "agent.rate_limited"},
+                            headers={"Retry-After": "1"})
+    async with _slots:
+        yield
 
 # ==========================================================
-# Helpers
+# Lifecycle（共有 HTTP クライアント）
 # ==========================================================
-def check_key(x_api_key: Optional[str]) -> None:
-    if API_KEY and x_api_key != API_KEY:
-        raise HTTPException(status_code=401, detail="unauthorized")
+@app.on_event("startup")
+async def _startup() -> None:
+    # google-auth などブロッキング処理に使うスレッドプールも同じ上限に揃える
+    to_thread.current_default_thread_limiter().total_tokens = MAX_CONCURRENCY
+    comfy.warm_mimetypes()
+    await gce.open_client()
 
-def ensure_params(project: str, zone: str, instance: str) -> None:
-    if not (project and zone and instance):
-        raise HTTPException(status_code=400, detail="PROJECT_ID/ZONE/INSTANCE not set")
-
-def get_access_token(scope: str = "https://www.googleapis.com/auth/cloud-platform") -> str:
-    creds, _ = google_auth_default(scopes=[scope])
-    if not creds.valid:
-        creds.refresh(Request())
-    return creds.token
-
-def _raise_http(status: int, text: str):
-    # JSONならそのまま、非JSONは先頭1000文字に圧縮
-    detail: Any = text
-    try:
-        import json
-        detail = json.loads(text)  # type: ignore
-    except Exception:
-        detail = {"error": text[:1000]}
-    raise HTTPException(status_code=status, detail=detail)
-
-def gce_req(method: str, url: str) -> Dict[str, Any]:
-    token = get_access_token()
-    r = _session.request(method, url, headers={"Authorization": f"Bearer {token}"},
-                         timeout=_DEFAULT_TIMEOUT)
-    if r.status_code >= 300:
-        _raise_http(r.status_code, r.text)
-    return r.json() if r.text else {}
-
-def instance_url(project: str, zone: str, instance: str) -> str:
-    return f"https://compute.googleapis.com/compute/v1/projects/{project}/zones/{zone}/instances/{instance}"
-
-def comfy_get(path: str, params: Optional[Dict[str, Any]] = None, stream: bool = False):
-    if not COMFY_BASEURL:
-        raise HTTPException(500, "COMFY_BASEURL not set")
-    url = f"{COMFY_BASEURL.rstrip('/')}/{path.lstrip('/')}"
-    r = _session.get(url, params=params, timeout=_DEFAULT_TIMEOUT, stream=stream)
-    if r.status_code >= 300:
-        _raise_http(r.status_code, r.text)
-    return r
-
-def comfy_post(path: str, json: Dict[str, Any]):
-    if not COMFY_BASEURL:
-        raise HTTPException(500, "COMFY_BASEURL not set")
-    url = f"{COMFY_BASEURL.rstrip('/')}/{path.lstrip('/')}"
-    r = _session.post(url, json=json, timeout=_DEFAULT_TIMEOUT)
-    if r.status_code >= 300:
-        _raise_http(r.status_code, r.text)
-    return r
+@app.on_event("shutdown")
+async def _shutdown() -> None:
+    await gce.close_client()
 
 # ==========================================================
 # Health
 # ==========================================================
 @app.get("/")
-def root():
+async def root():
     return {"ok": True, "service": "vm-ctrl"}
 
 # ==========================================================
 # Start / Stop / Status
 # ==========================================================
-@app.api_route("/vm/start", methods=["POST", "GET"])  # GETも許容
-def vm_start(
+@app.api_route("/vm/start", methods=["POST", "GET"], dependencies=[Depends(concurrency_slot)])  # GETも許容
+async def vm_start(
     project: str = Query(default=PROJECT_ID),
     zone: str    = Query(default=ZONE),
     instance: str= Query(default=INSTANCE),
@@ -129,11 +79,10 @@ def vm_start(
 ):
     check_key(x_api_key)
     ensure_params(project, zone, instance)
-    url = instance_url(project, zone, instance) + "/start"
-    return gce_req("POST", url)
+    return await gce_req("POST", instance_url(project, zone, instance, "/start"))
 
-@app.api_route("/vm/stop", methods=["POST", "GET"])   # GETも許容
-def vm_stop(
+@app.api_route("/vm/stop", methods=["POST", "GET"], dependencies=[Depends(concurrency_slot)])   # GETも許容
+async def vm_stop(
     project: str = Query(default=PROJECT_ID),
     zone: str    = Query(default=ZONE),
     instance: str= Query(default=INSTANCE),
@@ -141,11 +90,10 @@ def vm_stop(
 ):
     check_key(x_api_key)
     ensure_params(project, zone, instance)
-    url = instance_url(project, zone, instance) + "/stop"
-    return gce_req("POST", url)
+    return await gce_req("POST", instance_url(project, zone, instance, "/stop"))
 
-@app.api_route("/vm/status", methods=["GET", "POST"])  # POSTも許容
-def vm_status(
+@app.api_route("/vm/status", methods=["GET", "POST"], dependencies=[Depends(concurrency_slot)])  # POSTも許容
+async def vm_status(
     project: str = Query(default=PROJECT_ID),
     zone: str    = Query(default=ZONE),
     instance: str= Query(default=INSTANCE),
@@ -153,23 +101,35 @@ def vm_status(
 ):
     check_key(x_api_key)
     ensure_params(project, zone, instance)
-    j = gce_req("GET", instance_url(project, zone, instance))
-    return {"name": instance, "zone": zone, "status": j.get("status", "UNKNOWN")}
+    return await gce.instance_status(project, zone, instance)
+
+@app.api_route("/vm/wait", methods=["GET", "POST"], dependencies=[Depends(concurrency_slot)])
+async def vm_wait(
+    operation: str = Query(..., description="vm_start / vm_stop が返す Operation の name"),
+    project: str = Query(default=PROJECT_ID),
+    zone: str    = Query(default=ZONE),
+    timeout_sec: int = Query(120, ge=1, le=600),
+    x_api_key: Optional[str] = Header(default=None),
+):
+    """
+    Operation の完了を待つ。
+    返り値: {"done": true/false, "operation": "...", "status": "...", "error": {...}(任意)}
+    """
+    check_key(x_api_key)
+    if not (project and zone):
+        raise HTTPException(status_code=400, detail="PROJECT_ID/ZONE not set")
+    return await gce.wait_operation(project, zone, operation, timeout_sec)
 
 # ==========================================================
 # ComfyUI: ping / run / result / fetch
 # ==========================================================
-@app.get("/comfy/ping")
-def comfy_ping(x_api_key: Optional[str] = Header(default=None)):
+@app.get("/comfy/ping", dependencies=[Depends(concurrency_slot)])
+async def comfy_ping(x_api_key: Optional[str] = Header(default=None)):
     check_key(x_api_key)
-    try:
-        r = comfy_get("/system_stats")
-        return {"ok": r.ok, "status": r.status_code}
-    except Exception as e:
-        raise HTTPException(502, f"connect failed: {e}")
+    return await comfy.ping()
 
-@app.post("/comfy/run")
-def comfy_run(
+@app.post("/comfy/run", dependencies=[Depends(concurrency_slot)])
+async def comfy_run(
     payload: Dict[str, Any],
     x_api_key: Optional[str] = Header(default=None),
 ):
@@ -179,8 +139,8 @@ def comfy_run(
     """
     check_key(x_api_key)
     try:
-        r = comfy_post("/prompt", json=payload)
-        j = r.json()
+        r = await comfy_post("/prompt", json=payload)
+        j = orjson.loads(r.content)
         if "prompt_id" not in j:
             raise HTTPException(502, f"Unexpected response from ComfyUI: {j}")
         return j
@@ -189,11 +149,11 @@ def comfy_run(
     except Exception as e:
         raise HTTPException(502, f"ComfyUI error: {e}")
 
-@app.get("/comfy/result")
-def comfy_result(
+@app.get("/comfy/result", dependencies=[Depends(concurrency_slot)])
+async def comfy_result(
     prompt_id: str = Query(..., description="comfy_run が返す prompt_id"),
     timeout_sec: int = Query(60, ge=1, le=600),
-    poll_interval: float = Query(1.5, gt=0, le=10.0),
+    poll_interval: float = Query(1.5, gt=0, le=10.0, description="ポーリング間隔の上限（秒）"),
     x_api_key: Optional[str] = Header(default=None),
 ):
     """
@@ -201,44 +161,10 @@ def comfy_result(
     返り値: {"done": true/false, "files": [...], "error": "...(任意)"}
     """
     check_key(x_api_key)
-    deadline = time.time() + timeout_sec
-    last_error: Optional[str] = None
-
-    while time.time() < deadline:
-        try:
-            r = comfy_get(f"/history/{prompt_id}")
-            # 404 でなければ JSON
-            hist = r.json()
-            if prompt_id not in hist:
-                time.sleep(poll_interval)
-                continue
-
-            outputs = hist[prompt_id].get("outputs", {})
-            files: List[str] = []
-            for node_id, out in outputs.items():
-                for img in out.get("images", []):
-                    fn = img.get("filename")
-                    if fn:
-                        files.append(fn)
-
-            if files:
-                return {"done": True, "files": files}
-
-            # 画像まだ→継続
-            time.sleep(poll_interval)
-        except HTTPException as he:
-            # /history が未作成などで 404 の可能性（_raise_http が投げる）
-            last_error = str(he.detail)
-            time.sleep(poll_interval)
-        except Exception as e:
-            last_error = str(e)
-            time.sleep(poll_interval)
-
-    # タイムアウト
-    return JSONResponse(status_code=200, content={"done": False, "files": [], "error": last_error})
+    return ORJSONResponse(status_code=200, content=await wait_result(prompt_id, timeout_sec, poll_interval))
 
-@app.get("/comfy/fetch")
-def comfy_fetch(
+@app.get("/comfy/fetch", dependencies=[Depends(concurrency_slot)])
+async def comfy_fetch(
     filename: str = Query(..., description="ComfyUI の /view で参照するファイル名"),
     x_api_key: Optional[str] = Header(default=None),
 ):
@@ -248,12 +174,7 @@ def comfy_fetch(
     """
     check_key(x_api_key)
     try:
-        r = comfy_get("/view", params={"filename": filename}, stream=True)
-        mime = "image/png"
-        guess, _ = mimetypes.guess_type(filename)
-        if guess:
-            mime = guess
-        return StreamingResponse(r.iter_content(chunk_size=8192), media_type=mime)
+        return await fetch_response(filename)
     except HTTPException:
         raise
     except Exception as e: